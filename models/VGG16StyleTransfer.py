@@ -8,7 +8,6 @@ Content layer = conv5_2
 """
 
 import cv2
-import imageio
 import numpy as np
 from PIL import Image, ImageFont, ImageDraw, ImageEnhance
 import sys
@@ -32,7 +31,11 @@ class VGG16StyleTransfer(tf.keras.Model):
         if floatType == 32:
             self.floatType = tf.float32
         elif floatType == 16:
-            tf.keras.backend.set_floatx('float16')
+            # mixed precision: fp16 activations/GEMMs with fp32 variables,
+            # instead of set_floatx('float16') which also makes the loss
+            # accumulation and the optimized image fp16 (NaN prone and no
+            # faster since no tensor cores are used without loss scaling)
+            tf.keras.mixed_precision.set_global_policy('mixed_float16')
             self.floatType = tf.float16
         else:
             raise Exception('floatType should be either 32 or 16')
@@ -58,42 +61,61 @@ class VGG16StyleTransfer(tf.keras.Model):
         self.VGG16 = VGG16(input_shape=input_shape)
         self.VGG16_tilStage5 = self.VGG16.getUntilStage5()
 
-        # load weights from SSD to new VGG-16 model
-        ssd_seq_idx = 0
-        ssd_layer_idx = 0
-        for i in range(len(self.VGG16_tilStage5.layers)):
-            ssd_layer_idx = i
-            if i >= 13:
-                ssd_seq_idx = 1
-                ssd_layer_idx -= 13
-            self.VGG16_tilStage5.get_layer(index=i).set_weights(
-                SSD_backbone.get_layer(index=ssd_seq_idx).get_layer(
-                    index=ssd_layer_idx).get_weights())
-            self.VGG16_tilStage5.get_layer(index=i).trainable = False
+        # load weights from SSD to new VGG-16 model in one bulk call
+        # (the backbone is two stacked sequentials: flatten their layers
+        # in order and transfer all the weights at once instead of one
+        # NumPy round-trip per layer)
+        ssd_layers = SSD_backbone.get_layer(index=0).layers +\
+            SSD_backbone.get_layer(index=1).layers
+        self.VGG16_tilStage5.set_weights(
+            [weights
+             for layer in ssd_layers[:len(self.VGG16_tilStage5.layers)]
+             for weights in layer.get_weights()])
+        self.VGG16_tilStage5.trainable = False
         # del models that we won't use anymore
         del SSD_backbone
         del SSD300_model
 
-        self.style_layers = []
-
-        self.inputs = tf.keras.layers.Input(shape=input_shape)
-        self.x = self.VGG16_tilStage5.get_layer(index=0)(self.inputs)
-
-        for i in range(1, 7):
-            # get first 6 layers for the style loss
-            self.style_layers.append(self.x)
-            self.x = self.VGG16_tilStage5.get_layer(index=i)(self.x)
-
-        for i in range(7, len(self.VGG16_tilStage5.layers)-2):
-            self.x = self.VGG16_tilStage5.get_layer(index=i)(self.x)
-
-        # get first layer at index -2 for the content loss
-        self.content_layers = [self.x]
-
-        self.model = tf.keras.Model(
-            inputs=self.inputs, outputs=self.style_layers+self.content_layers)
+        # build the feature extractor as a single functional graph:
+        # one pass over the first 6 backbone layers whose outputs feed
+        # the style loss
+        # the [0, 255] -> [0, 1] normalization is part of the graph so
+        # XLA fuses it into the first conv instead of launching a
+        # separate divide kernel per forward pass (no ImageNet mean
+        # subtraction: the SSD weights were trained on [0, 1] inputs)
+        inputs = tf.keras.layers.Input(shape=input_shape)
+        x = tf.keras.layers.Rescaling(scale=1/255.0)(inputs)
+        features = []
+        for layer in self.VGG16_tilStage5.layers[:6]:
+            x = layer(x)
+            features.append(x)
+
+        self.model = tf.keras.Model(inputs=inputs, outputs=features)
         self.model.trainable = False
 
+        # the remaining layers (up to index -3 of the backbone) only feed
+        # the content loss; their activations are recomputed during the
+        # backward pass instead of being stored, which frees activation
+        # memory for larger frame batches at ~7% extra compute
+        self._content_tail = tf.keras.Sequential(
+            self.VGG16_tilStage5.layers[6:-2])
+        self._content_tail.trainable = False
+        self._content_tail_ckpt = tf.recompute_grad(self._content_tail)
+
+        # persistent variable holding the image being optimized
+        # allocated lazily (its leading dim depends on the batch size)
+        # the traced train step is rebuilt alongside it
+        self._generated_image = None
+        self._train_step = self._make_train_step()
+
+        # persistent variables holding the style gram targets, read by
+        # _train_step through stable handles (see _set_style_targets)
+        self._style_targets = None
+
+        # memoized loss-scale wrapper for the fp16 path
+        # (see _wrap_optimizer)
+        self._scaled_optimizer = None
+
     def get_features(self, data):
         """
         Method to get model outputs for style and content layers used by loss
@@ -101,13 +123,23 @@ class VGG16StyleTransfer(tf.keras.Model):
         Args:
             - (tf.Tensor) input model data with shape (1, 300, 300, 3)
         """
-        outputs = self.model(data/255.0)
+        outputs = self.model(data)
+        # content path from the last style activation, with gradient
+        # checkpointing (see __init__)
+        content_feature = self._content_tail_ckpt(outputs[-1])
 
         def gram_calc(data):
-            return tf.linalg.einsum('bijc,bijd->bcd', data, data) /\
-                tf.cast(data.shape[1] * data.shape[2], tf.float32)
-        style_features = [gram_calc(layer) for layer in outputs[:-1]]
-        return style_features, outputs[-1]
+            # reshape + matmul instead of einsum('bijc,bijd->bcd') to make
+            # sure the op dispatches to the tuned cuBLAS GEMM kernel
+            # computed in fp32: on the 300x300 layers h*w is 90000 and the
+            # matmul output also exceeds fp16's 65504 max, so an fp16 gram
+            # overflows to inf before the loss casts
+            b, h, w, c = tf.unstack(tf.shape(data))
+            flat = tf.cast(tf.reshape(data, (b, h * w, c)), tf.float32)
+            return tf.matmul(flat, flat, transpose_a=True) /\
+                tf.cast(h * w, tf.float32)
+        style_features = [gram_calc(layer) for layer in outputs]
+        return style_features, content_feature
 
     def get_loss(self, style_target, style_feature,
                  content_target, content_feature):
@@ -122,15 +154,159 @@ class VGG16StyleTransfer(tf.keras.Model):
             - (tf.Tensor) content_target with shape (1, W, H, C)
             - (tf.Tensor) content_feature with shape (1, W, H, C)
         """
-        style_loss = tf.add_n([
-            tf.reduce_mean(tf.square(features - targets))
-            for features, targets in zip(style_feature, style_target)])
-        content_loss = tf.add_n([
-            0.5 * tf.reduce_sum(tf.square(content_feature - content_target))])
+        # reductions run in fp32 so the loss does not underflow/overflow
+        # when the activations come out of the model in fp16
+        # mean per sample then sum over the batch, so a batched call
+        # optimizes every frame exactly as a batch-of-1 call would
+        # the per-layer terms are scalars: a plain sum keeps the graph to
+        # simple adds that XLA fuses, instead of add_n's variadic op
+        style_loss = sum(
+            tf.reduce_sum(tf.reduce_mean(
+                tf.square(tf.cast(features, tf.float32)
+                          - tf.cast(targets, tf.float32)), axis=[1, 2]))
+            for features, targets in zip(style_feature, style_target))
+        content_loss = 0.5 * tf.reduce_sum(tf.square(
+            tf.cast(content_feature, tf.float32)
+            - tf.cast(content_target, tf.float32)))
 
         return 1 * style_loss + 1e-30 * content_loss
 
-    def training(self, style_image, content_image, optimizer, epochs=1):
+    def _make_train_step(self):
+        """
+        Method to build the traced train step
+        A fresh tf.function is built each time the generated image
+        variable is reallocated (see _get_generated_image): variables —
+        optimizer slots included — may only be created on a Function's
+        first trace, so a step working on a new variable needs a new
+        trace cache
+        """
+
+        @tf.function(jit_compile=True)
+        def train_step(generated_image, content_targets, optimizer):
+            """
+            Function to run one optimization step on the generated image
+            Traced as a static graph so the whole forward + backward +
+            update runs in a single launch instead of op-by-op eager
+            dispatch
+            jit_compile=True lets XLA fuse the conv/ReLU/pool chains with
+            the gram and loss reductions (all shapes are static: 300x300
+            input)
+            The style targets are read from the instance variables set by
+            _set_style_targets instead of being passed as a Python list,
+            whose changing identity would trigger retraces
+
+            Args:
+                - (tf.Variable) generated_image with shape (1, W, H, 3)
+                - (tf.Tensor) content_targets: content layer output
+                - (tf.keras.optimizers) Optimizer to use
+            """
+            with tf.GradientTape() as tape:
+                # run the model on the current image
+                # (image updated at each run)
+                # get the style feature (outputs of the first 5 layers)
+                # and content feature (outputs of the layer with index -2)
+                style_features, content_features = self.get_features(
+                    generated_image)
+                # calculate the loss
+                loss = self.get_loss(self._style_targets, style_features,
+                                     content_targets, content_features)
+                if isinstance(optimizer,
+                              tf.keras.mixed_precision.LossScaleOptimizer):
+                    loss = optimizer.get_scaled_loss(loss)
+
+            # get gradients
+            gradients = tape.gradient(loss, generated_image)
+            if isinstance(optimizer,
+                          tf.keras.mixed_precision.LossScaleOptimizer):
+                gradients = optimizer.get_unscaled_gradients([gradients])[0]
+            # apply gradients wrt the image to update
+            optimizer.apply_gradients([(gradients, generated_image)])
+            # clip image to have a range of [0, 255]
+            generated_image.assign(
+              tf.clip_by_value(generated_image, clip_value_min=0.0,
+                               clip_value_max=255.0))
+
+        return train_step
+
+    def prepare_style(self, style_image):
+        """
+        Method to get the style targets (gram matrices of the first 6
+        layers outputs); computed once per style image and reusable
+        across every frame of a video
+
+        Args:
+            - (tf.Tensor) style_image with shape (1, W, H, 3)
+        """
+        style_targets, _ = self.get_features(style_image)
+        return self._set_style_targets(style_targets)
+
+    def _set_style_targets(self, style_targets):
+        """
+        Method to store the style targets in non-trainable variables on
+        the instance: _train_step reads them through these stable handles
+        so passing new target tensors (new frame, new style) updates the
+        values without triggering a tf.function retrace
+
+        Args:
+            - (list of tf.Tensor) style_targets: gram matrices of style image
+        """
+        if self._style_targets is None:
+            self._style_targets = tuple(
+                tf.Variable(target, trainable=False)
+                for target in style_targets)
+        elif self._style_targets is not style_targets:
+            for variable, target in zip(self._style_targets, style_targets):
+                variable.assign(target)
+        return self._style_targets
+
+    def _get_generated_image(self, content_image):
+        """
+        Method to get the variable holding the image being optimized,
+        initialized with the content image
+        The same variable handle is reused from one call to the next so
+        _train_step keeps a single trace and the optimizer allocates its
+        slots only once
+        When the shape changes (e.g. a different batch size) the variable
+        is reallocated and the train step is rebuilt, since the optimizer
+        slots for the new variable may only be created on the first trace
+        of a Function
+
+        Args:
+            - (tf.Tensor) content_image with shape (B, W, H, 3)
+        """
+        content_image = tf.cast(content_image, dtype=tf.float32)
+        if self._generated_image is None or \
+                self._generated_image.shape != content_image.shape:
+            self._generated_image = tf.Variable(content_image)
+            self._train_step = self._make_train_step()
+        else:
+            self._generated_image.assign(content_image)
+        return self._generated_image
+
+    def _wrap_optimizer(self, optimizer):
+        """
+        Method to wrap the optimizer for loss scaling in fp16: the
+        gradients are scaled up before backprop and unscaled before the
+        update so fp16 gradients do not underflow
+        The wrapper is memoized on the instance because _train_step keys
+        its trace cache on the optimizer's Python identity: a fresh
+        wrapper per call would retrace (and recompile under XLA) on every
+        frame of a video and reset the dynamic loss-scale state
+
+        Args:
+            - (tf.keras.optimizers) optimizer given by the caller
+        """
+        if self.floatType != tf.float16 or isinstance(
+                optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+            return optimizer
+        if self._scaled_optimizer is None or \
+                self._scaled_optimizer.inner_optimizer is not optimizer:
+            self._scaled_optimizer = \
+                tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+        return self._scaled_optimizer
+
+    def training(self, style_image, content_image, optimizer, epochs=1,
+                 record_intermediates=False, use_lbfgs=False):
         """
         Method to apply style transfer on content image
 
@@ -139,59 +315,199 @@ class VGG16StyleTransfer(tf.keras.Model):
             - (tf.Tensor) content_image with shape (1, W, H, 3)
             - (tf.keras.optimizers) Optimizer to use
             - (int) number of epoch
+            - (bool) record_intermediates: keep a PIL image per epoch
+            (forces a GPU to host copy each epoch, only for visualization)
+            - (bool) use_lbfgs: optimize with L-BFGS instead of the given
+            optimizer (needs tensorflow_probability); usually converges
+            in far fewer iterations than first-order optimizers
+        """
+        return self.training_with_targets(
+            self.prepare_style(style_image), content_image, optimizer, epochs,
+            record_intermediates, use_lbfgs)
+
+    def _lbfgs_minimize(self, style_targets, content_targets,
+                        generated_image, epochs):
+        """
+        Method to optimize the generated image with L-BFGS
+        Second-order curvature information makes it converge in far fewer
+        VGG forward/backward passes than Adam for this objective
+
+        Args:
+            - (list of tf.Tensor) style_targets: gram matrices of style image
+            - (tf.Tensor) content_targets: content layer output
+            - (tf.Variable) generated_image holding the initial image
+            - (int) epochs: maximum number of L-BFGS iterations
+        """
+        import tensorflow_probability as tfp
+
+        shape = generated_image.shape
+
+        @tf.function(jit_compile=True)
+        def loss_and_gradients(flat_image):
+            image = tf.reshape(flat_image, shape)
+            with tf.GradientTape() as tape:
+                tape.watch(image)
+                style_features, content_features = self.get_features(image)
+                loss = self.get_loss(style_targets, style_features,
+                                     content_targets, content_features)
+            gradients = tape.gradient(loss, image)
+            return loss, tf.reshape(gradients, [-1])
+
+        results = tfp.optimizer.lbfgs_minimize(
+            loss_and_gradients,
+            initial_position=tf.reshape(generated_image, [-1]),
+            max_iterations=epochs, tolerance=1e-5)
+        generated_image.assign(tf.clip_by_value(
+            tf.reshape(results.position, shape),
+            clip_value_min=0.0, clip_value_max=255.0))
+
+    def training_with_targets(self, style_targets, content_image,
+                              optimizer, epochs=1,
+                              record_intermediates=False, use_lbfgs=False):
+        """
+        Method to apply style transfer on content image with precomputed
+        style targets (got from prepare_style)
+
+        Args:
+            - (list of tf.Tensor) style_targets: gram matrices of style image
+            - (tf.Tensor) content_image with shape (1, W, H, 3)
+            - (tf.keras.optimizers) Optimizer to use
+            - (int) number of epoch
+            - (bool) record_intermediates: keep a PIL image per epoch
+            (forces a GPU to host copy each epoch, only for visualization)
+            - (bool) use_lbfgs: optimize with L-BFGS instead of the given
+            optimizer (needs tensorflow_probability); usually converges
+            in far fewer iterations than first-order optimizers
         """
         images = []
 
-        # infer the model on the style image to get the style targets
-        # (result of the first 6 layers)
-        style_targets, _ = self.get_features(style_image)
+        style_targets = self._set_style_targets(style_targets)
+        optimizer = self._wrap_optimizer(optimizer)
 
         # infer the model on the content image to get the content targets
         # (result of the layer of index -2)
         _, content_targets = self.get_features(content_image)
 
-        # generate a copy of our content image
+        # copy of our content image in the persistent variable
         # this copy will be update with the gradients over the epochs
-        generated_image = tf.cast(content_image, dtype=tf.float32)
-        generated_image = tf.Variable(generated_image)
+        generated_image = self._get_generated_image(content_image)
+
+        if use_lbfgs:
+            self._lbfgs_minimize(style_targets, content_targets,
+                                 generated_image, epochs)
+            images.append(tf.keras.preprocessing.image.array_to_img(
+                generated_image[0].numpy()))
+            return images
 
-        images.append(tf.keras.preprocessing.image.array_to_img(
-            tf.squeeze(content_image)))
+        if record_intermediates:
+            images.append(tf.keras.preprocessing.image.array_to_img(
+                tf.squeeze(content_image)))
 
         # training loop
         for n in tqdm(range(epochs), position=0, leave=True):
-            with tf.GradientTape() as tape:
-                # run the model on the current image
-                # (image updated at each run)
-                # get the style feature (outputs of the first 5 layers)
-                # and content feature (outputs of the layer with index -2)
-                style_features, content_features = self.get_features(
-                    generated_image)
-                # calculate the loss
-                loss = self.get_loss(style_targets, style_features,
-                                     content_targets, content_features)
+            self._train_step(generated_image, content_targets, optimizer)
 
-            # get gradients
-            gradients = tape.gradient(loss, generated_image)
-            # apply gradients wrt the image to update
-            optimizer.apply_gradients([(gradients, generated_image)])
-            # clip image to have a range of [0, 255]
-            generated_image.assign(
-              tf.clip_by_value(generated_image, clip_value_min=0.0,
-                               clip_value_max=255.0))
+            if record_intermediates:
+                images.append(tf.keras.preprocessing.image.array_to_img(
+                    generated_image[0].numpy()))
 
-            tmp_img = tf.Variable(generated_image)
+        # single device to host copy when intermediates are not recorded
+        if not record_intermediates:
             images.append(tf.keras.preprocessing.image.array_to_img(
-                tf.squeeze(tmp_img)))
+                generated_image[0].numpy()))
         return images
 
+    def _stylize_batch(self, style_targets, content_batch, optimizer,
+                       epochs=1, init_image=None):
+        """
+        Method to apply style transfer on a batch of content images
+        The frames are independent so they are optimized in parallel:
+        B times more work per kernel launch than running them one-by-one
+
+        Args:
+            - (list of tf.Tensor) style_targets: gram matrices of style image
+            - (tf.Tensor) content_batch with shape (B, W, H, 3)
+            - (tf.keras.optimizers) Optimizer to use
+            - (int) number of epoch
+            - (tf.Tensor) init_image: optional warm start for the
+            optimization, same shape as content_batch; defaults to the
+            content batch itself
+        """
+        self._set_style_targets(style_targets)
+        optimizer = self._wrap_optimizer(optimizer)
+
+        # content targets of each frame of the batch
+        _, content_targets = self.get_features(content_batch)
+
+        generated_image = self._get_generated_image(
+            content_batch if init_image is None else init_image)
+
+        for n in range(epochs):
+            self._train_step(generated_image, content_targets, optimizer)
+
+        return [tf.keras.preprocessing.image.array_to_img(image)
+                for image in generated_image.numpy()]
+
     def call(self, style_image, content_image, optimizer, epochs=1):
         return self.training(style_image, content_image, optimizer, epochs)
 
+    def _make_thumbnail(self, image, size, line_width):
+        """
+        Method to build a thumbnail with a white frame, to paste on the
+        bottom left of a result image
+
+        Args:
+            - (PIL.Image) image to turn into a thumbnail
+            - (tuple) size: target thumbnail resolution
+            - (int) line_width: width of the white frame
+        """
+        thumbnail = image.resize(size, Image.ANTIALIAS)
+        draw = ImageDraw.Draw(thumbnail)
+        min_point = (-10, 0)
+        end_point = (thumbnail.size[0]-3, thumbnail.size[1]+10)
+        draw.rectangle((min_point, end_point), outline=(255, 255, 255),
+                       width=line_width)
+        return thumbnail
+
+    def _make_style_thumbnail(self, style_image_on_gif, orig_height,
+                              resize, line_width):
+        """
+        Method to build the style image thumbnail; it does not depend on
+        the frame so it is computed once and pasted on every result
+
+        Args:
+            - (PIL.Image) style_image_on_gif: the 300x300 style image
+            - (int) orig_height: width of the original content image
+            - (tuple) resize: target resolution of the result
+            - (int) line_width: width of the white frame
+        """
+        style_resize_ratio = int(round(orig_height/resize[0]*0.8))
+        return self._make_thumbnail(
+            style_image_on_gif,
+            (int(style_image_on_gif.size[0]//style_resize_ratio),
+             int(style_image_on_gif.size[1]//style_resize_ratio)),
+            line_width)
+
+    def _paste_thumbnails(self, image_result, thumbnails):
+        """
+        Method to paste the thumbnails on a result image, stacked from
+        the bottom left corner up
+
+        Args:
+            - (PIL.Image) image_result: image to paste the thumbnails on
+            - (list of PIL.Image) thumbnails, from bottom to top
+        """
+        ypos_offset = 0
+        for thumbnail in thumbnails:
+            ypos_offset += thumbnail.size[1]
+            image_result.paste(
+                thumbnail, (0, image_result.size[1]-ypos_offset))
+
     def inferOnVideo(self, style_image_path, optimizer, epochs,
                      video_path, out_path, start_idx=0, end_idx=-1,
-                     skip=1, resize=None, fps=30,
-                     add_content_img=False, add_style_img=False, line_width=2):
+                     skip=1, resize=None, fps=30, batch_size=1,
+                     warm_epochs=None, add_content_img=False,
+                     add_style_img=False, line_width=2):
         """
         Method to infer model on a MP4 video
         Create a gif with the results
@@ -207,112 +523,159 @@ class VGG16StyleTransfer(tf.keras.Model):
             - (int) skip: idx%skip != 0 is skipped
             - (tuple) resize: target resolution for the gif
             - (int) fps: fps of the output gif
+            - (int) batch_size: number of frames stylized in parallel
+            - (int) warm_epochs: number of epoch from the second batch
+            onward (warm started from the previous result), default epochs
             - (bool) add_content_img: add content image on bottom left
             - (bool) add_style_img: add style image on bottom left of result
         """
         style_image = Image.open(style_image_path)
         style_image = np.array(style_image)
         style_image = cv2.resize(style_image, (300, 300),
-                                 interpolation=cv2.INTER_NEAREST)
+                                 interpolation=cv2.INTER_AREA)
         style_image = tf.expand_dims(
             tf.convert_to_tensor(style_image, dtype=tf.float32), 0)
 
         style_image_on_gif = tf.keras.preprocessing.image.array_to_img(
             tf.squeeze(style_image))
 
+        # style targets only depend on the style image:
+        # compute them once instead of once per frame
+        style_targets = self.prepare_style(style_image)
+
         cap = cv2.VideoCapture(video_path)
         imgs = []
-        i = 0
         number_of_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         if end_idx != -1:
             number_of_frame = end_idx
+        orig_height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        orig_width = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if resize is None:
+            resize = (orig_height, orig_width)
 
-        for _ in tqdm(range(number_of_frame), position=0, leave=True):
-            ret, frame = cap.read()
-            if not ret:
-                break
-            i += 1
-            if i <= start_idx:
-                continue
-            elif end_idx >= 0 and i > end_idx:
-                break
-            if i % skip != 0:
-                continue
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            orig_height, orig_width = img.size[0], img.size[1]
-            if resize is None:
-                resize = (img.size[0], img.size[1])
-
-            content_image = np.array(img)
-            content_image = cv2.resize(
-                content_image, (300, 300), interpolation=cv2.INTER_NEAREST)
-            content_image = tf.expand_dims(
-                tf.convert_to_tensor(content_image, dtype=tf.float32), 0)
-
-            image_result = self.training(
-                style_image, content_image, optimizer, epochs)[-1]
-
-            image_result = image_result.resize(resize, Image.ANTIALIAS)
-
-            # add content image on final gif
-            if add_content_img and not add_style_img:
-                min_img_size = (resize[0]//3, resize[1]//3)
-                pil_content = img.resize(min_img_size, Image.ANTIALIAS)
-                draw = ImageDraw.Draw(pil_content)
-                min_point = (-10, 0)
-                end_point = (pil_content.size[0]-3, pil_content.size[1]+10)
-                draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                               width=line_width)
-                image_result.paste(
-                    pil_content, (0, image_result.size[1]-pil_content.size[1]))
-
-            # add style image on final gif
-            if not add_content_img and add_style_img:
-                style_resize_ratio = int(round(orig_height/resize[0]*0.8))
-                pil_style = style_image_on_gif.resize(
-                    (int(style_image_on_gif.size[0]//style_resize_ratio),
-                     int(style_image_on_gif.size[1]//style_resize_ratio)),
-                    Image.ANTIALIAS)
-                draw = ImageDraw.Draw(pil_style)
-                min_point = (-10, 0)
-                end_point = (pil_style.size[0]-3, pil_style.size[1]+10)
-                draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                               width=line_width)
-                image_result.paste(
-                    pil_style, (0, image_result.size[1]-pil_style.size[1]))
-
-            # add content and style images on final gif
-            if add_content_img and add_style_img:
-                min_img_size = (resize[0]//3, resize[1]//3)
-                pil_content = img.resize(min_img_size, Image.ANTIALIAS)
-                draw = ImageDraw.Draw(pil_content)
-                min_point = (-10, 0)
-                end_point = (pil_content.size[0]-3, pil_content.size[1]+10)
-                draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                               width=line_width)
-                image_result.paste(
-                    pil_content, (0, image_result.size[1]-pil_content.size[1]))
-
-                style_resize_ratio = int(round(orig_height/resize[0]*0.8))
-                pil_style = style_image_on_gif.resize(
-                    (int(style_image_on_gif.size[0]//style_resize_ratio),
-                     int(style_image_on_gif.size[1]//style_resize_ratio)),
-                    Image.ANTIALIAS)
-                draw = ImageDraw.Draw(pil_style)
-                min_point = (-10, 0)
-                end_point = (pil_style.size[0]-3, pil_style.size[1]+10)
-                draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                               width=line_width)
-                ypos_offset = pil_content.size[1]+pil_style.size[1]
-                image_result.paste(
-                    pil_style, (0, image_result.size[1]-ypos_offset))
-
-            imgs.append(image_result)
+        def frame_gen():
+            # decode + resize of the kept frames, run by tf.data on the
+            # CPU while the GPU stylizes the previous batch
+            # the full resolution frame is only carried along when it is
+            # needed for the content thumbnail
+            i = 0
+            for _ in range(number_of_frame):
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                i += 1
+                if i <= start_idx:
+                    continue
+                elif end_idx >= 0 and i > end_idx:
+                    break
+                if i % skip != 0:
+                    continue
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                content_image = cv2.resize(
+                    frame, (300, 300), interpolation=cv2.INTER_AREA)
+                if add_content_img:
+                    yield content_image, frame
+                else:
+                    yield content_image
+
+        if add_content_img:
+            dataset = tf.data.Dataset.from_generator(
+                frame_gen,
+                output_signature=(
+                    tf.TensorSpec((300, 300, 3), tf.uint8),
+                    tf.TensorSpec((orig_width, orig_height, 3), tf.uint8)))
+            dataset = dataset.map(
+                lambda content_image, frame: (
+                    tf.cast(content_image, tf.float32), frame),
+                num_parallel_calls=tf.data.AUTOTUNE)
+        else:
+            dataset = tf.data.Dataset.from_generator(
+                frame_gen,
+                output_signature=tf.TensorSpec((300, 300, 3), tf.uint8))
+            dataset = dataset.map(
+                lambda content_image: tf.cast(content_image, tf.float32),
+                num_parallel_calls=tf.data.AUTOTUNE)
+        dataset = dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+        if warm_epochs is None:
+            warm_epochs = epochs
+
+        # the style thumbnail is the same on every frame
+        pil_style = None
+        if add_style_img:
+            pil_style = self._make_style_thumbnail(
+                style_image_on_gif, orig_height, resize, line_width)
+
+        # stylize the kept frames by batch: the frames are independent
+        # so batching them keeps the GPU busy at batch size > 1
+        # from the second batch onward the optimization is warm started
+        # from the last stylized frame (consecutive frames are close, so
+        # warm_epochs can be much smaller than epochs)
+        # each batch is composited as soon as it is stylized so the raw
+        # full resolution frames are never all resident at once
+        train_step = self._train_step
+        tracing_count = train_step.experimental_get_tracing_count()
+        prev_result = None
+        for batch in tqdm(dataset, position=0, leave=True):
+            if add_content_img:
+                content_batch, frame_batch = batch
+            else:
+                content_batch, frame_batch = batch, None
+            # pad a smaller final batch to batch_size by repeating its
+            # last frame: the generated image variable and the train-step
+            # trace keep one constant shape for the whole video
+            # (the padded outputs are discarded below)
+            valid = int(content_batch.shape[0])
+            if valid < batch_size:
+                content_batch = tf.concat(
+                    [content_batch,
+                     tf.repeat(content_batch[-1:], batch_size - valid,
+                               axis=0)], axis=0)
+            if prev_result is None:
+                results = self._stylize_batch(
+                    style_targets, content_batch, optimizer, epochs)
+            else:
+                init_image = tf.convert_to_tensor(np.broadcast_to(
+                    prev_result, content_batch.shape), dtype=tf.float32)
+                results = self._stylize_batch(
+                    style_targets, content_batch, optimizer, warm_epochs,
+                    init_image=init_image)
+            results = results[:valid]
+            prev_result = self._generated_image.numpy()[valid-1]
+
+            for idx, image_result in enumerate(results):
+                image_result = image_result.resize(resize, Image.ANTIALIAS)
+
+                # add content and/or style images on final gif
+                thumbnails = []
+                if add_content_img:
+                    thumbnails.append(self._make_thumbnail(
+                        Image.fromarray(frame_batch[idx].numpy()),
+                        (resize[0]//3, resize[1]//3), line_width))
+                if add_style_img:
+                    thumbnails.append(pil_style)
+                self._paste_thumbnails(image_result, thumbnails)
+
+                imgs.append(image_result)
+
+        # every batch has the same shape (the last one is padded), so the
+        # whole video must run on a single trace of the train step; more
+        # means trace thrash was reintroduced (e.g. unstable optimizer or
+        # target identities)
+        if self._train_step is not train_step:
+            # rebuilt with the variable on the first batch: its traces
+            # all belong to this video
+            tracing_count = self._train_step.experimental_get_tracing_count()
+        else:
+            tracing_count = \
+                train_step.experimental_get_tracing_count() - tracing_count
+        assert tracing_count <= 1, (
+            "_train_step was traced %d times over the video" % tracing_count)
 
+        # duration is set at write time so the gif does not need to be
+        # decoded and re-encoded afterwards just to fix its fps
         imgs[0].save(out_path, format='GIF', append_images=imgs[1:],
-                     save_all=True, loop=0)
-        gif = imageio.mimread(out_path)
-        imageio.mimsave(out_path, gif, fps=fps)
+                     save_all=True, loop=0, duration=int(1000/fps))
 
     def inferOnImage(self, style_image_path, optimizer, epochs,
                      image_path, out_path, resize=None,
@@ -331,85 +694,41 @@ class VGG16StyleTransfer(tf.keras.Model):
             - (bool) add_content_img: add the content image on bottom left
             - (bool) add_style_img: add style image on bottom left of result
         """
-        content_image_init = Image.open("imgs/content.jpg")
+        content_image_init = Image.open(image_path)
         orig_height, orig_width = \
             content_image_init.size[0], content_image_init.size[1]
         if resize is None:
             resize = (orig_height, orig_width)
         content_image = np.array(content_image_init)
         content_image = cv2.resize(content_image, (300, 300),
-                                   interpolation=cv2.INTER_NEAREST)
+                                   interpolation=cv2.INTER_AREA)
         content_image = tf.expand_dims(
             tf.convert_to_tensor(content_image, dtype=tf.float32), 0)
 
         style_image = Image.open(style_image_path)
         style_image = np.array(style_image)
         style_image = cv2.resize(style_image, (300, 300),
-                                 interpolation=cv2.INTER_NEAREST)
+                                 interpolation=cv2.INTER_AREA)
         style_image = tf.expand_dims(
             tf.convert_to_tensor(style_image, dtype=tf.float32), 0)
 
         style_image_on_gif = tf.keras.preprocessing.image.array_to_img(
             tf.squeeze(style_image))
 
-        image_result = self.training(
-            style_image, content_image, optimizer, epochs)[-1]
+        image_result = self.training_with_targets(
+            self.prepare_style(style_image), content_image, optimizer,
+            epochs)[-1]
 
         image_result = image_result.resize(resize, Image.ANTIALIAS)
 
-        # add content image on final gif
-        if add_content_img and not add_style_img:
-            min_img_size = (resize[0]//3, resize[1]//3)
-            pil_content = content_image_init.resize(min_img_size,
-                                                    Image.ANTIALIAS)
-            draw = ImageDraw.Draw(pil_content)
-            min_point = (-10, 0)
-            end_point = (pil_content.size[0]-3, pil_content.size[1]+10)
-            draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                           width=line_width)
-            image_result.paste(
-                pil_content, (0, image_result.size[1]-pil_content.size[1]))
-
-        # add style image on final gif
-        if not add_content_img and add_style_img:
-            style_resize_ratio = int(round(orig_height/resize[0]*0.8))
-            pil_style = style_image_on_gif.resize(
-                (int(style_image_on_gif.size[0]//style_resize_ratio),
-                 int(style_image_on_gif.size[1]//style_resize_ratio)),
-                Image.ANTIALIAS)
-            draw = ImageDraw.Draw(pil_style)
-            min_point = (-10, 0)
-            end_point = (pil_style.size[0]-3, pil_style.size[1]+10)
-            draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                           width=line_width)
-            image_result.paste(
-                pil_style, (0, image_result.size[1]-pil_style.size[1]))
-
-        # add content and style images on final gif
-        if add_content_img and add_style_img:
-            min_img_size = (resize[0]//3, resize[1]//3)
-            pil_content = content_image_init.resize(min_img_size,
-                                                    Image.ANTIALIAS)
-            draw = ImageDraw.Draw(pil_content)
-            min_point = (-10, 0)
-            end_point = (pil_content.size[0]-3, pil_content.size[1]+10)
-            draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                           width=line_width)
-            image_result.paste(
-                pil_content, (0, image_result.size[1]-pil_content.size[1]))
-
-            style_resize_ratio = int(round(orig_height/resize[0]*0.8))
-            pil_style = style_image_on_gif.resize(
-                (int(style_image_on_gif.size[0]//style_resize_ratio),
-                 int(style_image_on_gif.size[1]//style_resize_ratio)),
-                Image.ANTIALIAS)
-            draw = ImageDraw.Draw(pil_style)
-            min_point = (-10, 0)
-            end_point = (pil_style.size[0]-3, pil_style.size[1]+10)
-            draw.rectangle((min_point, end_point), outline=(255, 255, 255),
-                           width=line_width)
-            ypos_offset = pil_content.size[1]+pil_style.size[1]
-            image_result.paste(
-                pil_style, (0, image_result.size[1]-ypos_offset))
+        # add content and/or style images on final image
+        thumbnails = []
+        if add_content_img:
+            thumbnails.append(self._make_thumbnail(
+                content_image_init, (resize[0]//3, resize[1]//3), line_width))
+        if add_style_img:
+            thumbnails.append(self._make_style_thumbnail(
+                style_image_on_gif, orig_height, resize, line_width))
+        self._paste_thumbnails(image_result, thumbnails)
 
         image_result.save(out_path)